@@ -13,9 +13,9 @@ from sqlalchemy.exc import DBAPIError
 from etl.bbg_transport.dto import RequestDataItem, RequestItem, RequestOptionItem
 from etl.core import util
 from etl.core.util import uri_post, sanitize_cmd_line
-from etl.repo.fnd_cfdw.etl_config import EtlConfigRepo
 from etl.repo.pim_pm.pl_bbg_batch import PlBbgBatchRepo
 from etl.repo.pim_pm.pl_bbg_batch_series_vw import PlBbgBatchSeriesVwRepo
+from ju.config_cache import get_etl_config
 
 USAGE = ['Queuer Agent',
          # ('--source_code',
@@ -36,13 +36,13 @@ class QueuerAgent(object):
 
         logging.info('QueuerAgent')
         self.USERNAME = getpass.getuser()
-        md = EtlConfigRepo.instance.get_by_config_code('PL_BT_ENDPOINT')
+        md = get_etl_config('PL_BT_ENDPOINT')
         self.base_url = md.config_value
-        md = EtlConfigRepo.instance.get_by_config_code('PL_BT_DESCRIPTION')
+        md = get_etl_config('PL_BT_DESCRIPTION')
         self.description = md.config_value
-        md = EtlConfigRepo.instance.get_by_config_code('PL_BT_FORMAT')
+        md = get_etl_config('PL_BT_FORMAT')
         self.response_format = md.config_value
-        md = EtlConfigRepo.instance.get_by_config_code('PL_BT_REQUESTOR_CODE')
+        md = get_etl_config('PL_BT_REQUESTOR_CODE')
         self.requestor_code = md.config_value
 
     def __enter__(self):
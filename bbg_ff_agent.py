@@ -4,12 +4,17 @@
 Post request, gets response From Bloomberg Transport and downloads the CVS file.
 """
 
+import functools
 import getpass
 import json
 import logging
 import os
 import sys
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 from shutil import copyfile
+from urlparse import urlparse
 
 
 from sqlalchemy.exc import DBAPIError
@@ -22,9 +27,10 @@ from etl.enum.cor_da.gen.bt_status import BtStatusEnum
 from etl.enum.pim_da.gen.bbg_interface import BbgInterfaceEnum
 from etl.enum.pim_da.gen.bbg_program import BbgProgramEnum
 from etl.enum.pim_da.gen.dats_batch_status import DatsBatchStatusEnum
-from etl.repo.fnd_cfdw.etl_config import EtlConfigRepo
 from etl.repo.pim_da.dats_bbg_batch import DatsBbgBatchRepo
 from etl.repo.pim_da.dats_bbg_batch_series import DatsBbgBatchSeriesRepo
+from ju.config_cache import get_etl_config
+from ju.poll_scheduler import PollScheduler
 
 USAGE = ['BGG DATS  Automation Agent', ['action', {'help': 'REQUEST or POLL'}]]
 
@@ -46,6 +52,33 @@ GETHISTORY = BbgProgramEnum.GETHISTORY.value
 
 SAPI = BbgInterfaceEnum.SAPI.value
 
+DATS_BT_POST_LIMIT = 'DATS_BT_POST_LIMIT'
+DEFAULT_POST_LIMIT = 1
+STATUS_FLUSH_SIZE = 50
+DATS_BT_POLL_WORKERS = 'DATS_BT_POLL_WORKERS'
+DATS_BT_POLL_HOST_LIMIT = 'DATS_BT_POLL_HOST_LIMIT'
+DEFAULT_POLL_WORKERS = 1
+DEFAULT_POLL_HOST_LIMIT = 4
+POLL_SCHEDULE_FILE = os.path.join(tempfile.gettempdir(), 'dats_bt_poll_schedule.json')
+
+
+class HostLimiter(object):
+    """
+        Caps the number of concurrent requests made to each host.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def for_url(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return self._semaphores[host]
+
 
 class FetcherAgent(object):
     """
@@ -81,6 +114,40 @@ class FetcherAgent(object):
         except DBAPIError as err:
             logging.error(err)
 
+    @staticmethod
+    def _get_config_int(config_code, default):
+        config = get_etl_config(config_code)
+        try:
+            return int(config.config_value)
+        except (AttributeError, TypeError, ValueError):
+            logging.info('%s is not configured, using %s', config_code, default)
+            return default
+
+    @staticmethod
+    def _update_requests(updates, repo):
+        """
+        Saves the updates through the repo in one transaction. Each save commits a savepoint, that
+        only releases it, and the batch is committed at the end.
+        :param updates: List of Dicts - batch_id and the columns to set
+        """
+        if not updates:
+            return
+        logging.info('Updating %s rows in the staging table', len(updates))
+        session = repo.db.session
+        try:
+            for update in updates:
+                session.begin_nested()
+                update_row = repo.get_by_batch_id(update['batch_id'])
+                for column, value in update.items():
+                    setattr(update_row, column, value)
+                repo.save(update_row)
+            session.commit()
+        except DBAPIError as ex:
+            logging.error(ex)
+            while session.transaction is not None and session.transaction.nested:
+                session.rollback()
+            session.rollback()
+
 
 class RequestAgent(FetcherAgent):
     """
@@ -138,14 +205,11 @@ class RequestAgent(FetcherAgent):
         fields = list(self._get_request_fields(result_series))
         # request_options = [RequestOptionItem(option_name=key, option_value=headers[key])
         #                    for key in headers]
-        request = RequestItem(request_description=EtlConfigRepo.instance.
-                              get_by_config_code('DATS_BT_DESCRIPTION').config_value,
-                              requestor_code=EtlConfigRepo.instance.
-                              get_by_config_code('DATS_BT_REQ_CODE').config_value,
+        request = RequestItem(request_description=get_etl_config('DATS_BT_DESCRIPTION').config_value,
+                              requestor_code=get_etl_config('DATS_BT_REQ_CODE').config_value,
                               program_code=obj.bbg_program_code,
                               interface_code=obj.bbg_interface_code,
-                              response_format_code=EtlConfigRepo.instance.
-                              get_by_config_code('DATS_BT_FORMAT').config_value,
+                              response_format_code=get_etl_config('DATS_BT_FORMAT').config_value,
                               request_data_items=data_items,
                               request_options=request_options,
                               request_fields=fields)
@@ -161,15 +225,11 @@ class RequestAgent(FetcherAgent):
                    GETHISTORY: [GETHISTORY.lower(), gh_range]}
         if obj.bbg_program_code == GETHISTORY:
             headers['DATERANGE'] = pc_dict[obj.bbg_program_code][1]
-        headers['PROGRAMFLAG'] = EtlConfigRepo.instance. \
-            get_by_config_code('PROGRAMFLAG').config_value
-        headers['COMPRESS'] = EtlConfigRepo.instance. \
-            get_by_config_code('COMPRESS').config_value
-        headers['FIRMNAME'] = EtlConfigRepo.instance. \
-            get_by_config_code('FIRMNAME').config_value
+        headers['PROGRAMFLAG'] = get_etl_config('PROGRAMFLAG').config_value
+        headers['COMPRESS'] = get_etl_config('COMPRESS').config_value
+        headers['FIRMNAME'] = get_etl_config('FIRMNAME').config_value
         headers['PROGRAMNAME'] = pc_dict[obj.bbg_program_code][0]
-        headers['USERNUMBER'] = EtlConfigRepo.instance. \
-            get_by_config_code('USERNUMBER').config_value
+        headers['USERNUMBER'] = get_etl_config('USERNUMBER').config_value
         return headers
 
     @staticmethod
@@ -181,53 +241,80 @@ class RequestAgent(FetcherAgent):
 
         return list(set(request_fields_list))
 
-    def _post_to_bt(self, payload, end_point, obj, db_repo):
+    @staticmethod
+    def _post_to_bt(payload, end_point):
 
         logging.info('Sending the request to BT')
         logging.info('POST: %s, \r\n\t%s', end_point, payload)
-        try:
-            response = uri_post(end_point + 'request_data', payload)
-            logging.info('response: %s \r\nresponse:\t%s', end_point, response)
-            return response
-        except ClientException as ex:
-            logging.error(ex)
-            self._update_request(obj.batch_id, None, None,
-                                 payload, HTTP_ERROR, db_repo)
+        response = uri_post(end_point + 'request_data', payload)
+        logging.info('response: %s \r\nresponse:\t%s', end_point, response)
+        return response
+
+    def _get_payloads(self, priority_list, repo):
+
+        payloads = []
+        for i in priority_list:
+            logging.info("Fetching the records with batch_id" + ' ' + str(i.batch_id))
+            try:
+                result_batch = repo.list_by_batch_id(i.batch_id)
+                payloads.append((i.batch_id, self._get_request_object(i, result_batch)))
+            except Exception as ex:
+                logging.error(ex)
+        return payloads
 
     @staticmethod
-    def _update_request(batch_id, bt_request_id, bt_status_code,
-                        request_obj, batch_status_code, repo):
+    def _payload_json(payload):
+        # the json text posted to BT, its length feeds the poll schedule size estimate
+        return payload if isinstance(payload, basestring) else json.dumps(payload.to_json())
+
+    def _submit(self, job, end_point):
 
-        logging.info('Updating the staging the table')
+        batch_id, payload = job
+        update = dict(batch_id=batch_id, bt_request_id=None, bt_status_code=None,
+                      bt_request_payload=self._payload_json(payload))
         try:
-            update_row = repo.get_by_batch_id(batch_id)
-            update_row.batch_status_code = batch_status_code
-            update_row.bt_request_id = bt_request_id
-            update_row.bt_status_code = bt_status_code
-            update_row.bt_request_payload = request_obj
-            repo.save(update_row)
-        except DBAPIError as ex:
+            response = self._post_to_bt(payload, end_point)
+            update.update(batch_status_code=SENT_TO_BT, bt_request_id=response['request_id'],
+                          bt_status_code=str(response['request_status']))
+        except ClientException as ex:
+            logging.error(ex)
+            update['batch_status_code'] = HTTP_ERROR
+        except Exception as ex:
             logging.error(ex)
+            return None
+        return update
 
     def run(self, action, ref_actions, end_point):
         """
-        Get the response for all the requests and  update the table.
+        Post the queued batches to BT, up to DATS_BT_POST_LIMIT at a time in priority order, and
+        update the table in batches of STATUS_FLUSH_SIZE.
         """
         db_repo = DatsBbgBatchRepo()
         result = self._get_request(db_repo, action, ref_actions)
         priority_list = self._get_priority_list(result)
-        repo = DatsBbgBatchSeriesRepo()
-        for i in priority_list:
-            logging.info("Fetching the records with batch_id" + ' ' + str(i.batch_id))
-            try:
-                result_batch = repo.list_by_batch_id(i.batch_id)
-                obj = self._get_request_object(i, result_batch)
-                response = self._post_to_bt(obj, end_point, i, db_repo)
-                self._update_request(i.batch_id, response['request_id'],
-                                     str(response['request_status']),
-                                     str(obj), SENT_TO_BT, db_repo)
-            except Exception as ex:
-                logging.error(ex)
+        payloads = self._get_payloads(priority_list, DatsBbgBatchSeriesRepo())
+        program_codes = {i.batch_id: i.bbg_program_code for i in priority_list}
+        poll_scheduler = PollScheduler(POLL_SCHEDULE_FILE)
+        post_limit = self._get_config_int(DATS_BT_POST_LIMIT, DEFAULT_POST_LIMIT)
+        logging.info('Posting %s requests to BT, %s at a time', len(payloads), post_limit)
+        pool = ThreadPool(processes=post_limit)
+        updates = []
+        try:
+            # imap hands the payloads to the workers in priority order
+            for update in pool.imap(functools.partial(self._submit, end_point=end_point), payloads):
+                if update:
+                    updates.append(update)
+                    if update['batch_status_code'] == SENT_TO_BT:
+                        poll_scheduler.register(update['bt_request_id'], program_codes[update['batch_id']],
+                                                len(update['bt_request_payload']))
+                if len(updates) >= STATUS_FLUSH_SIZE:
+                    self._update_requests(updates, db_repo)
+                    updates = []
+        finally:
+            pool.close()
+            pool.join()
+            self._update_requests(updates, db_repo)
+            poll_scheduler.save()
 
 
 class ResponseAgent(FetcherAgent):
@@ -235,6 +322,10 @@ class ResponseAgent(FetcherAgent):
         This class gets the response from the Bloomberg Transport.
     """
 
+    def __init__(self):
+        super(ResponseAgent, self).__init__()
+        self._host_limiter = HostLimiter(self._get_config_int(DATS_BT_POLL_HOST_LIMIT, DEFAULT_POLL_HOST_LIMIT))
+
     @staticmethod
     def _get_request_status_by_url(obj, end_point):
 
@@ -248,29 +339,26 @@ class ResponseAgent(FetcherAgent):
             logging.error(ex)
 
     @staticmethod
-    def _update_request(data_file_path, batch_id,
-                        bt_status_code, repo):
+    def _get_status_update(data_file_path, batch_id, bt_status_code):
 
-        logging.info('Updating the staging the table')
         status_dict = {BBGERROR: BBG_ERROR,
                        BTERROR: BT_ERROR, SUCCESS: BT_DONE}
-        try:
-            update_row = repo.get_by_batch_id(batch_id)
-            if bt_status_code not in [PENDING, INITIAL]:
-                update_row.batch_status_code = status_dict[bt_status_code]
-                update_row.bt_response_file_path = data_file_path
-            update_row.bt_status_code = bt_status_code
-            repo.save(update_row)
-        except DBAPIError as err:
-            logging.error(err)
+        update = dict(batch_id=batch_id, bt_status_code=bt_status_code)
+        if bt_status_code not in [PENDING, INITIAL]:
+            update.update(batch_status_code=status_dict[bt_status_code],
+                          bt_response_file_path=data_file_path)
+        return update
+
+    def _poll(self, obj, end_point):
+
+        with self._host_limiter.for_url(end_point):
+            return obj, self._get_request_status_by_url(obj, end_point)
 
     @staticmethod
     def copy_file(src, dst, program_code, batch_id):
 
-        dats_bt_getdata_ext = EtlConfigRepo.instance. \
-            get_by_config_code('DATS_BT_GETDATA_EXT').config_value
-        dats_bt_gethis_ext = EtlConfigRepo.instance. \
-            get_by_config_code('DATS_BT_GETHIS_EXT').config_value
+        dats_bt_getdata_ext = get_etl_config('DATS_BT_GETDATA_EXT').config_value
+        dats_bt_gethis_ext = get_etl_config('DATS_BT_GETHIS_EXT').config_value
         if not os.path.isdir(dst):
             logging.info("Can't copy %s to destination: %s", src, dst)
             raise Exception('Destination path is incorrect: %s', dst)
@@ -288,19 +376,40 @@ class ResponseAgent(FetcherAgent):
 
     def run(self, action, ref_actions, end_point):
         """
-        Get the response for all the requests and  update the table.
+        Check the status of the requests sent to BT that are due for a check, concurrently, copy the
+        finished files as their status comes back and update the table in one go at the end of the cycle.
         """
-        dats_bt_file_path = EtlConfigRepo.instance. \
-            get_by_config_code('DATS_BT_FILE_PATH').config_value
+        dats_bt_file_path = get_etl_config('DATS_BT_FILE_PATH').config_value
         db_repo = DatsBbgBatchRepo()
-        result = self._get_request(db_repo, action, ref_actions)
-        for i in result:
-            response = self._get_request_status_by_url(i, end_point)
-            if response['request_status'] == SUCCESS:
-                self.copy_file(response['data_file_path'].strip(),
-                               dats_bt_file_path, i.bbg_program_code, i.batch_id)
-            self._update_request(response['data_file_path'], i.batch_id,
-                                 response['request_status'], db_repo)
+        poll_scheduler = PollScheduler(POLL_SCHEDULE_FILE)
+        result = [i for i in self._get_request(db_repo, action, ref_actions) or []
+                  if poll_scheduler.is_due(i.bt_request_id)]
+        workers = self._get_config_int(DATS_BT_POLL_WORKERS, DEFAULT_POLL_WORKERS)
+        logging.info('Checking the status of %s requests, %s at a time', len(result), workers)
+        pool = ThreadPool(processes=workers)
+        updates = []
+        try:
+            for i, response in pool.imap_unordered(functools.partial(self._poll, end_point=end_point), result):
+                if not response:
+                    continue
+                try:
+                    # only a success is a completion time to learn from, errors are dropped from the schedule
+                    if response['request_status'] in [BBGERROR, BTERROR]:
+                        poll_scheduler.forget(i.bt_request_id)
+                    else:
+                        poll_scheduler.checked(i.bt_request_id, response['request_status'] == SUCCESS)
+                    if response['request_status'] == SUCCESS:
+                        self.copy_file(response['data_file_path'].strip(),
+                                       dats_bt_file_path, i.bbg_program_code, i.batch_id)
+                    updates.append(self._get_status_update(response['data_file_path'], i.batch_id,
+                                                           response['request_status']))
+                except Exception as ex:
+                    logging.error(ex)
+        finally:
+            pool.close()
+            pool.join()
+            self._update_requests(updates, db_repo)
+            poll_scheduler.save()
 
 
 def main():
@@ -312,12 +421,9 @@ def main():
               'POLL': {'agent_name': 'Response Agent', 'agent_class': ResponseAgent}}
     if user_action in option.keys():
         try:
-            dats_bt_req_action = EtlConfigRepo.instance. \
-                get_by_config_code('DATS_BT_REQ_ACTION').config_value
-            dats_bt_poll_action = EtlConfigRepo.instance. \
-                get_by_config_code('DATS_BT_POLL_ACTION').config_value
-            end_point = EtlConfigRepo.instance. \
-                get_by_config_code('DATS_BT_ENDPOINT').config_value
+            dats_bt_req_action = get_etl_config('DATS_BT_REQ_ACTION').config_value
+            dats_bt_poll_action = get_etl_config('DATS_BT_POLL_ACTION').config_value
+            end_point = get_etl_config('DATS_BT_ENDPOINT').config_value
             ref_actions = [dats_bt_req_action, dats_bt_poll_action]
             logging.info("%s started", option[user_action]['agent_name'])
             with option[user_action]['agent_class']() as agent:
@@ -1,21 +1,194 @@
-import gzip
-import io
+import functools
+import heapq
+import itertools
 import json
 import logging
 import numpy as np
 from core.rest import rest_config
-import sys
+import threading
 import time
-from core.rest.client import ClientException
+import zlib
+from collections import defaultdict, namedtuple
+from multiprocessing.pool import ThreadPool
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from dats_config import \
     BbgTransportForbidden, BbgTransportUnknown, BbgTransportErrorStatus,\
     BbgTransport404Status
 from dats_repo import DatsProvider
-from etl.core.util import uri_post, uri_get
 from etl.core.timed import timed
 from etl.bbg_transport.dto import RequestDataItem, RequestItem, \
     RequestOptionItem
-from requests_toolbelt.streaming_iterator import StreamingIterator
+
+GZIP_LEVEL = 6
+MIN_UPLOAD_CHUNK = 64 * 1024
+MAX_UPLOAD_CHUNK = 1024 * 1024
+ITEM_OVERHEAD_BYTES = 48
+MAX_PACK_GROUPS = 200
+Shard = namedtuple('Shard', ['requests', 'response', 'metrics', 'error'])
+
+
+def pack_requests(requests, fixed_fields, overhead_cells):
+    """
+    Group requests so that each group only asks BBG for the mnemonics of its
+    own securities. Securities with the same mnemonic set start in one group,
+    then groups are merged greedily while merging costs fewer cells
+    (requests x fields) than the overhead_cells of an extra BT request
+    :param requests:
+    :param fixed_fields: fields sent with every request
+    :param overhead_cells:
+    :return: list of request lists
+    """
+    fixed_fields = frozenset(fixed_fields)
+    by_security = defaultdict(list)
+    for r in requests:
+        by_security[(r.req_ticker, r.req_yellow_key, r.req_overrides,
+                     r.req_optional_elements)].append(r)
+    by_mnemonics = defaultdict(list)
+    for rows in by_security.values():
+        by_mnemonics[frozenset(r.req_mnemonic for r in rows)].extend(rows)
+    if len(by_mnemonics) > MAX_PACK_GROUPS:
+        logging.info('{} mnemonic sets, too many to pack'
+                     .format(len(by_mnemonics)))
+        return [requests]
+
+    def cost(mnemonics, rows):
+        return len(rows) * len(mnemonics | fixed_fields)
+
+    def saving(a, b):
+        (ma, ra, ca), (mb, rb, cb) = groups[a], groups[b]
+        return ca + cb + overhead_cells - \
+            (len(ra) + len(rb)) * len(ma | mb | fixed_fields)
+
+    # each pair's saving is worked out once, a merge keeps the lower key and
+    # adds the pairs of the merged group, pairs of changed groups are skipped
+    # by version. Pops the biggest saving first, ties in key order
+    groups = {k: (m, rows, cost(m, rows))
+              for k, (m, rows) in enumerate(by_mnemonics.items())}
+    versions = dict.fromkeys(groups, 0)
+    heap = [(-saving(a, b), a, b, 0, 0)
+            for a, b in itertools.combinations(sorted(groups), 2)]
+    heap = [h for h in heap if h[0] <= 0]
+    heapq.heapify(heap)
+    while heap:
+        _, a, b, version_a, version_b = heapq.heappop(heap)
+        if versions.get(a) != version_a or versions.get(b) != version_b:
+            continue
+        mnemonics = groups[a][0] | groups[b][0]
+        rows = groups[a][1] + groups[b][1]
+        groups[a] = (mnemonics, rows, cost(mnemonics, rows))
+        versions[a] += 1
+        del groups[b], versions[b]
+        for c in groups:
+            if c == a:
+                continue
+            pair = (min(a, c), max(a, c))
+            pair_saving = saving(*pair)
+            if pair_saving >= 0:
+                heapq.heappush(heap, (-pair_saving,) + pair +
+                               (versions[pair[0]], versions[pair[1]]))
+    return [groups[k][1] for k in sorted(groups)]
+
+
+class PayloadMetrics(object):
+    """
+    Size of a request payload, filled in while it is serialized
+    """
+
+    def __init__(self, items=0, fields=0):
+        self.items = items
+        self.fields = fields
+        self.raw_bytes = None
+        self.compressed_bytes = None
+
+    def __str__(self):
+        size = '{} bytes'.format(self.raw_bytes)
+        if self.compressed_bytes is not None:
+            size += ' ({} compressed)'.format(self.compressed_bytes)
+        return '{} for {} requests x {} fields'.format(size, self.items,
+                                                       self.fields)
+
+    @staticmethod
+    def combine(metrics):
+        total = PayloadMetrics(items=sum(m.items for m in metrics),
+                               fields=max([m.fields for m in metrics] or [0]))
+        total.raw_bytes = sum(m.raw_bytes or 0 for m in metrics)
+        if any(m.compressed_bytes is not None for m in metrics):
+            total.compressed_bytes = sum(m.compressed_bytes or 0
+                                         for m in metrics)
+        return total
+
+
+class ShardedResponse(object):
+    """
+    Composite handle for a post split across several BT requests, one
+    Shard of requests, BT response and payload metrics per request
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    @property
+    def request_ids(self):
+        return [s.response['request_id'] for s in self.shards if s.response]
+
+    @property
+    def good_shards(self):
+        return [s for s in self.shards
+                if s.response and not s.response.get('is_error')]
+
+    @property
+    def errors(self):
+        return [s.error for s in self.shards if s.error is not None]
+
+
+class BtSession(object):
+    """
+    Keep-alive HTTP session to BT with a connection pool, timeouts, retries of
+    idempotent calls and per endpoint latency counters
+    """
+
+    def __init__(self, base_url, pool_size, timeout, retries):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = requests.Session()
+        # urllib3 only retries idempotent methods, so a POST is never sent twice
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=Retry(total=retries, backoff_factor=0.5,
+                                                status_forcelist=[502, 503, 504]))
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._latency = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        start = time.time()
+        try:
+            response = self._session.request(method, url, timeout=self.timeout,
+                                             **kwargs)
+        finally:
+            self._record(url, time.time() - start)
+        response.raise_for_status()
+        return response.json()
+
+    def _record(self, url, seconds):
+        endpoint = url[len(self.base_url):].split('/')[0] \
+            if url.startswith(self.base_url) else url
+        with self._lock:
+            calls, total = self._latency.get(endpoint, (0, 0.0))
+            self._latency[endpoint] = (calls + 1, total + seconds)
+
+    @property
+    def latency(self):
+        with self._lock:
+            return {endpoint: {'calls': calls, 'seconds': total,
+                               'avg': total / calls}
+                    for endpoint, (calls, total) in self._latency.items()}
+
+    def close(self):
+        self._session.close()
 
 
 class BtClient:
@@ -35,6 +208,15 @@ class BtClient:
         self.bt_request_fields = bt_config.get_mandatory_mnemonics()
         self.bt_error_status = bt_config.bt_error_status()
         self.bt_complete_status = bt_config.bt_complete_status()
+        self.payload_metrics = None
+        self.compress_upload = bt_config.compress_upload
+        self.shard_max_items = bt_config.shard_max_items
+        self.shard_max_bytes = bt_config.shard_max_bytes
+        self.pack_overhead_cells = bt_config.pack_overhead_cells
+        self.session = BtSession(self.base_url,
+                                 pool_size=bt_config.http_pool_size,
+                                 timeout=bt_config.http_timeout,
+                                 retries=bt_config.http_retries)
 
     def __enter__(self):
         self.start_time = time.time()
@@ -50,8 +232,12 @@ class BtClient:
         self.end_time = time.time()
         elapsed_time = self.end_time - self.start_time
         logging.info('Overall time elapsed: %ss', elapsed_time)
+        for endpoint, stats in self.session.latency.items():
+            logging.info('%s: %s calls, %.3fs avg', endpoint, stats['calls'],
+                         stats['avg'])
         logging.info('%s completed at %s', self.__class__.__name__,
                      self.end_time)
+        self.session.close()
 
     @staticmethod
     def _get_data_items(requests):
@@ -76,10 +262,14 @@ class BtClient:
                                              option_value='yes'))
         return options
 
-    def get_request_item(self, requests, has_exclusive_pricing_source):
+    def get_request_item(self, requests, has_exclusive_pricing_source,
+                         metrics=None):
         data_items = self._get_data_items(requests)
         fields = self._get_fields(requests)
         options = self._options(has_exclusive_pricing_source)
+        if metrics is not None:
+            metrics.items = len(data_items)
+            metrics.fields = len(fields)
         return RequestItem(request_description=self.request_description,
                            requestor_code=self.requester_code,
                            program_code=self.program_codes,
@@ -89,81 +279,159 @@ class BtClient:
                            request_options=options,
                            request_fields=fields)
 
+    def _shard(self, requests):
+        """
+        Split requests into shards of at most shard_max_items requests and
+        shard_max_bytes estimated payload bytes
+        :param requests:
+        :return:
+        """
+        shards, shard, shard_bytes = [], [], 0
+        for r in requests:
+            size = len(r.req_ticker) + len(r.req_yellow_key or '') + \
+                len(r.req_overrides or '') + \
+                len(r.req_optional_elements or '') + ITEM_OVERHEAD_BYTES
+            if shard and (len(shard) >= self.shard_max_items or
+                          shard_bytes + size > self.shard_max_bytes):
+                shards.append(shard)
+                shard, shard_bytes = [], 0
+            shard.append(r)
+            shard_bytes += size
+        if shard or not shards:
+            shards.append(shard)
+        return shards
+
     @timed()
     def post(self, req, has_pricing_source=False):
         """
-        Call BT api [POST] and keep polling until response has complete status
-        or times out
+        Call BT api [POST], splitting the requests into shards that are
+        posted concurrently
         :param req:
         :param has_pricing_source:
-        :return:
+        :return: ShardedResponse with the BT response of every shard, a
+        shard that failed has no response and the error it raised
         """
-        logging.info('Submitting to BT...')
-        payload = self.get_request_item(req, has_pricing_source).to_json()
-        logging.info('payload size is {} bytes for {} requests'
-                     .format(self.get_size(payload), len(req)))
+        groups = pack_requests(req, self.bt_request_fields,
+                               self.pack_overhead_cells)
+        shards = [s for g in groups for s in self._shard(g)]
+        logging.info('Submitting {} requests to BT in {} shard(s) of {} '
+                     'field set(s), {} cells...'
+                     .format(len(req), len(shards), len(groups),
+                             sum(len(s) * len(self._get_fields(s))
+                                 for s in shards)))
+        post_shard = functools.partial(self._post_shard,
+                                       has_pricing_source=has_pricing_source)
+        if len(shards) == 1:
+            results = [post_shard(shards[0])]
+        else:
+            pool = ThreadPool(processes=min(len(shards),
+                                            self.session.pool_size))
+            try:
+                results = pool.map(post_shard, shards)
+            finally:
+                pool.close()
+                pool.join()
+        self.payload_metrics = PayloadMetrics.combine([r.metrics
+                                                       for r in results])
+        return ShardedResponse(results)
 
+    def _post_shard(self, req, has_pricing_source):
+        metrics = PayloadMetrics()
+        payload = self.get_request_item(req, has_pricing_source,
+                                        metrics).to_json()
+        response, error = None, None
+        # errors are kept with the shard, so the shards already posted are
+        # still returned when another one fails
         try:
-            response = self._post(payload=payload)
-        except ClientException as ex:
-            status = ex.detail_json.get('status')
+            response = self.handle_response(
+                self._post(payload=payload, metrics=metrics))
+            logging.info('payload size is {}'.format(metrics))
+        except requests.HTTPError as ex:
+            status = ex.response.status_code
             logging.exception('BBG Transport API call failed: ' + ex.message)
             if status == 403:
-                raise BbgTransportForbidden('Forbidden: ' +
-                                            ex.detail_json.get('msg'))
+                error = BbgTransportForbidden('Forbidden: ' +
+                                              ex.response.text)
         except Exception as ex:
             logging.exception('BBG Transport Server Error: ' + ex.message)
-            raise
-        else:
-            return self.handle_response(response)
+            error = ex
+        return Shard(requests=req, response=response, metrics=metrics,
+                     error=error)
 
-    def _post(self, payload):
+    def _post(self, payload, metrics=None):
         logging.info('url: ' + self.base_url + 'request_data')
-        return uri_post(url=self.base_url + 'request_data',
-                        payload=payload) #,
-                        # headers={'Content-Encoding': 'gzip'},
-                        # request_serializer=self.stream_serializer)
+        if not self.compress_upload:
+            body = json.dumps(payload)
+            if metrics:
+                metrics.raw_bytes = len(body)
+            return self.session.request('POST', self.base_url + 'request_data',
+                                        data=body,
+                                        headers={'Content-Type': rest_config.MIME_JSON})
+        content_type, body = self.stream_serializer(payload, metrics=metrics)
+        return self.session.request('POST', self.base_url + 'request_data',
+                                    data=body,
+                                    headers={'Content-Type': content_type,
+                                             'Content-Encoding': 'gzip'})
 
-    def stream_serializer(self, data, request_schema=None):
+    def stream_serializer(self, data, request_schema=None, metrics=None):
         """
         Stream Serializer will compress and stream
         :param data:
+        :param metrics: PayloadMetrics to fill in with the byte counts
         :return:
         """
-        zipped_payload = self._compress(data)
-        logging.info('compressed payload size is {} bytes'
-                     .format(self.get_size(zipped_payload)))
-        return rest_config.MIME_JSON,\
-               StreamingIterator(size=len(zipped_payload),
-                                 iterator=self._gen(zipped_payload))
+        return rest_config.MIME_JSON, self._gzip_stream(data, metrics)
 
     @staticmethod
-    def _compress(data):
-        buf = io.BytesIO()
-        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
-            json.dump(data, f)
-        return buf.getvalue()
-
-    @staticmethod
-    def _gen(data):
+    def _gzip_stream(data, metrics=None):
         """
-        chunk generator
+        gzip the json encoding of data as it is produced, yielding chunks that
+        grow from MIN_UPLOAD_CHUNK to MAX_UPLOAD_CHUNK bytes
         :param data:
+        :param metrics: PayloadMetrics to fill in with the byte counts
         :return:
         """
-        for i in range(0, len(data), 1000):
-            yield data[i:i + 1000]
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        chunk_size = MIN_UPLOAD_CHUNK
+        raw_size = compressed_size = 0
+        raw, zipped = [], []
+        raw_len = zipped_len = 0
+        for piece in json.JSONEncoder().iterencode(data):
+            raw.append(piece)
+            raw_len += len(piece)
+            if raw_len < MIN_UPLOAD_CHUNK:
+                continue
+            block = compressor.compress(''.join(raw))
+            raw_size += raw_len
+            raw, raw_len = [], 0
+            if block:
+                zipped.append(block)
+                zipped_len += len(block)
+            if zipped_len >= chunk_size:
+                chunk = ''.join(zipped)
+                compressed_size += len(chunk)
+                zipped, zipped_len = [], 0
+                chunk_size = min(chunk_size * 2, MAX_UPLOAD_CHUNK)
+                yield chunk
+        raw_size += raw_len
+        chunk = ''.join(zipped) + compressor.compress(''.join(raw)) + \
+            compressor.flush()
+        compressed_size += len(chunk)
+        if metrics:
+            metrics.raw_bytes = raw_size
+            metrics.compressed_bytes = compressed_size
+        yield chunk
 
     def get(self, url):
         try:
             logging.info('url: ' + url)
             response = self._get(url)
-        except ClientException as ex:
-            status = ex.detail_json.get('status')
+        except requests.HTTPError as ex:
+            status = ex.response.status_code
             logging.exception('BBG Transport API call failed: ' + ex.message)
             if status == 403:
-                raise BbgTransportForbidden('Forbidden: ' +
-                                            ex.detail_json.get('msg'))
+                raise BbgTransportForbidden('Forbidden: ' + ex.response.text)
             elif status == 404:
                 raise BbgTransport404Status('Request Id not found')
         else:
@@ -175,9 +443,8 @@ class BtClient:
     def get_status_url(self, bt_request_id):
         return self.base_url + 'check_status/' + bt_request_id
 
-    @staticmethod
-    def _get(url):
-        return uri_get(url)
+    def _get(self, url):
+        return self.session.request('GET', url)
 
     def handle_response(self, response):
         """
@@ -196,21 +463,3 @@ class BtClient:
                                           .format(response['request_status'],
                                                   errors))
         return response
-
-    def get_size(self, obj, seen=None):
-        size = sys.getsizeof(obj)
-        if seen is None:
-            seen = set()
-        obj_id = id(obj)
-        if obj_id in seen:
-            return 0
-        seen.add(obj_id)
-        if isinstance(obj, dict):
-            size += sum([self.get_size(v, seen) for v in obj.values()])
-            size += sum([self.get_size(k, seen) for k in obj.keys()])
-        elif hasattr(obj, '__dict__'):
-            size += self.get_size(obj.__dict__, seen)
-        elif hasattr(obj, '__iter__') and not isinstance(obj, (
-        str, bytes, bytearray)):
-            size += sum([self.get_size(i, seen) for i in obj])
-        return size
@@ -1,7 +1,8 @@
 import logging
 from abc import ABCMeta, abstractmethod
 from enum import Enum
-from werkzeug.utils import cached_property
+from config_cache import config_cache
+from dats_repo import DEFAULT_BULK_CHUNK_SIZE
 from etl.repo.fnd_cfdw.etl_app_config import EtlAppConfigRepo
 
 
@@ -18,6 +19,15 @@ class Code(Enum):
     INTERFACE_CODE = 'INTERFACE_CODE'
     REQUEST_LIMIT = 'REQUEST_LIMIT'
     POLL_LIMIT = 'POLL_LIMIT'
+    HTTP_POOL_SIZE = 'HTTP_POOL_SIZE'
+    HTTP_CONNECT_TIMEOUT = 'HTTP_CONNECT_TIMEOUT'
+    HTTP_READ_TIMEOUT = 'HTTP_READ_TIMEOUT'
+    HTTP_RETRIES = 'HTTP_RETRIES'
+    COMPRESS_UPLOAD = 'COMPRESS_UPLOAD'
+    SHARD_MAX_ITEMS = 'SHARD_MAX_ITEMS'
+    SHARD_MAX_BYTES = 'SHARD_MAX_BYTES'
+    PACK_OVERHEAD_CELLS = 'PACK_OVERHEAD_CELLS'
+    BULK_CHUNK_SIZE = 'BULK_CHUNK_SIZE'
     UNKNOWN = '#UNK#'
 
     @staticmethod
@@ -28,6 +38,15 @@ class Code(Enum):
             return Code.UNKNOWN
 
 
+DEFAULT_HTTP_POOL_SIZE = 10
+DEFAULT_HTTP_CONNECT_TIMEOUT = 10
+DEFAULT_HTTP_READ_TIMEOUT = 300
+DEFAULT_HTTP_RETRIES = 3
+DEFAULT_SHARD_MAX_ITEMS = 5000
+DEFAULT_SHARD_MAX_BYTES = 5 * 1024 * 1024
+DEFAULT_PACK_OVERHEAD_CELLS = 10000
+
+
 # Configuration Base
 class BtClientConfigBase:
 
@@ -63,8 +82,11 @@ class BtClientConfigBase:
     def bt_endpoint(self):
         return self.cfg_dict.get(Code.BT_ENDPOINT)
 
-    @cached_property
+    @property
     def cfg_dict(self):
+        return config_cache.get(('APP', self._app_code), self._load_cfg_dict)
+
+    def _load_cfg_dict(self):
         codes = self.app_config_repo.list_by_app_code(self._app_code)
         return {Code.get(c.config_code): c.config_value for c in codes}
 
@@ -86,3 +108,36 @@ class BtClientConfigBase:
     @property
     def response_format_code(self):
         return self.cfg_dict.get(Code.BT_FORMAT)
+
+    @property
+    def http_pool_size(self):
+        return int(self.cfg_dict.get(Code.HTTP_POOL_SIZE) or DEFAULT_HTTP_POOL_SIZE)
+
+    @property
+    def http_timeout(self):
+        return (float(self.cfg_dict.get(Code.HTTP_CONNECT_TIMEOUT) or DEFAULT_HTTP_CONNECT_TIMEOUT),
+                float(self.cfg_dict.get(Code.HTTP_READ_TIMEOUT) or DEFAULT_HTTP_READ_TIMEOUT))
+
+    @property
+    def http_retries(self):
+        return int(self.cfg_dict.get(Code.HTTP_RETRIES) or DEFAULT_HTTP_RETRIES)
+
+    @property
+    def compress_upload(self):
+        return str(self.cfg_dict.get(Code.COMPRESS_UPLOAD)).upper() in ('Y', 'YES', 'TRUE', '1')
+
+    @property
+    def shard_max_items(self):
+        return int(self.cfg_dict.get(Code.SHARD_MAX_ITEMS) or DEFAULT_SHARD_MAX_ITEMS)
+
+    @property
+    def shard_max_bytes(self):
+        return int(self.cfg_dict.get(Code.SHARD_MAX_BYTES) or DEFAULT_SHARD_MAX_BYTES)
+
+    @property
+    def pack_overhead_cells(self):
+        return int(self.cfg_dict.get(Code.PACK_OVERHEAD_CELLS) or DEFAULT_PACK_OVERHEAD_CELLS)
+
+    @property
+    def bulk_chunk_size(self):
+        return int(self.cfg_dict.get(Code.BULK_CHUNK_SIZE) or DEFAULT_BULK_CHUNK_SIZE)
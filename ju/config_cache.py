@@ -0,0 +1,50 @@
+import threading
+import time
+
+from etl.repo.fnd_cfdw.etl_config import EtlConfigRepo
+
+CONFIG_CACHE_TTL = 5 * 60
+ETL_CONFIG_KEY = ('ETL_CONFIG',)
+
+
+class ConfigCache(object):
+    """
+    Process wide cache of config lookups. Each key holds every code of one config source, loaded
+    with one query on the first get and again after ttl seconds or an invalidate.
+    """
+
+    def __init__(self, ttl, clock=time.time):
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        """
+        The cached value of key, load() builds it on a miss or once it is older than ttl
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._clock() - entry[0] > self.ttl:
+                entry = (self._clock(), load())
+                self._entries[key] = entry
+            return entry[1]
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+config_cache = ConfigCache(ttl=CONFIG_CACHE_TTL)
+
+
+def get_etl_config(config_code):
+    """
+    EtlConfigRepo.instance.get_by_config_code from the cache, None when the code is not configured
+    """
+    configs = config_cache.get(ETL_CONFIG_KEY, lambda: {c.config_code: c for c in EtlConfigRepo.instance.list_all()})
+    return configs.get(config_code)
+
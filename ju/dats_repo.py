@@ -1,5 +1,9 @@
 import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+
 import numpy as np
+import pandas as pd
 from werkzeug.utils import cached_property
 from etl.repo.pim_da.bbg_return_status import BbgReturnStatusRepo
 from etl.repo.pim_da.dats_bbg_request import DatsBbgRequestRepo
@@ -8,6 +12,8 @@ from etl.repo.pim_da.dats_series_bbg import DatsSeriesBbgRepo
 from etl.repo.pim_da.dats_series_tss_meta import DatsSeriesTssMetaRepo
 from etl.repo.pim_da.dats_tss_field_rule import DatsTssFieldRuleRepo
 PROVIDER = 'BBG'
+DEFAULT_BULK_CHUNK_SIZE = 1000
+IN_LIST_SIZE = 1000
 
 
 class DatsRepoBase(object):
@@ -57,7 +63,59 @@ class DatsRepoBase(object):
         return self._dats_series_bbg_repo
 
 
+class DatsSeriesLookup(object):
+    """
+    In-process map of DATS_SERIES rows by dats_code and dats_id. Keys not seen yet are fetched
+    together with one IN-list query per IN_LIST_SIZE keys.
+    """
+
+    KEYS = ('dats_code', 'dats_id')
+
+    def __init__(self, repo=None):
+        self._repo = repo
+        self._series = {key: {} for key in self.KEYS}
+
+    @property
+    def repo(self):
+        if self._repo is None:
+            self._repo = DatsSeriesRepo()
+        return self._repo
+
+    def resolve(self, key, values):
+        """
+        {value: DATS_SERIES row} for the distinct values of key, KeyError when one is not in DATS_SERIES
+        """
+        cache = self._series[key]
+        values = set(values)
+        missing = list(values.difference(cache))
+        if missing:
+            column = getattr(self.repo.model, key)
+            for i in range(0, len(missing), IN_LIST_SIZE):
+                for series in self.repo.query.filter(column.in_(missing[i:i + IN_LIST_SIZE])).all():
+                    for k in self.KEYS:
+                        self._series[k][getattr(series, k)] = series
+            unknown = values.difference(cache)
+            if unknown:
+                raise KeyError('{} {} not in DATS_SERIES'.format(key, sorted(unknown)))
+        return {v: cache[v] for v in values}
+
+    def columns(self, keys, key, attrs):
+        """
+        DataFrame of the attrs of the DATS_SERIES row of each of keys, aligned with the keys Series
+        """
+        found = self.resolve(key, keys.unique())
+        table = pd.DataFrame([[getattr(s, a) for a in attrs] for s in found.values()],
+                             index=list(found), columns=attrs)
+        return table.reindex(keys.values).set_index(keys.index)
+
+
 class DatsBbgRequest:
+    COLUMNS = ('dats_bbg_request_id', 'dats_bbg_request_status_code',
+               'req_ticker', 'req_yellow_key', 'req_mnemonic',
+               'req_bbg_interface_code', 'req_pricing_source', 'req_overrides',
+               'req_optional_elements', 'req_is_register_series', 'req_tag',
+               'bt_request_id')
+
     def __init__(self, dats_bbg_request_id=None, dats_bbg_request_status_code=None,
                  req_ticker=None, req_yellow_key=None, req_mnemonic=None,
                  req_bbg_interface_code=None, req_pricing_source=None,
@@ -105,6 +163,58 @@ class DatsProvider(DatsRepoBase):
 
     def __init__(self):
         super(DatsProvider, self).__init__()
+        self._pending_writes = None
+        self._pending_updates = None
+
+    @contextmanager
+    def bulk_writes(self, chunk_size=DEFAULT_BULK_CHUNK_SIZE):
+        """
+        Buffer the request updates and saves made in the block, then write
+        them in one transaction: the status updates first, through the repo
+        update, then the saves, chunk_size rows per executemany. Nothing is
+        written when the block raises
+        """
+        self._pending_writes = {}
+        self._pending_updates = OrderedDict()
+        try:
+            yield
+            writes, updates = self._pending_writes, self._pending_updates
+        finally:
+            self._pending_writes, self._pending_updates = None, None
+        self._write_all(updates, writes.values(), chunk_size)
+
+    def _buffer_writes(self, mappings):
+        # one mapping per row, later changes win column by column
+        for m in mappings:
+            self._pending_writes.setdefault(m['dats_bbg_request_id'], {}).update(m)
+
+    def _write_all(self, updates, mappings, chunk_size):
+        if not updates and not mappings:
+            return
+        logging.info('Writing {} request status updates and {} request rows'
+                     .format(len(updates), len(mappings)))
+        repo = self._dats_bbg_request_repo_
+        session = repo.db.session
+        by_update = OrderedDict()
+        for request_id, update in updates.items():
+            by_update.setdefault(update, []).append(request_id)
+        try:
+            for (status_to, bt_request_id, public_msg), request_ids in by_update.items():
+                for i in range(0, len(request_ids), IN_LIST_SIZE):
+                    # the repo commits each IN-list it updates, in a savepoint
+                    # that only releases it and the block stays one transaction
+                    session.begin_nested()
+                    repo.update(request_ids[i:i + IN_LIST_SIZE], status_to,
+                                bt_request_id, public_msg)
+            for i in range(0, len(mappings), chunk_size):
+                session.bulk_update_mappings(repo.model,
+                                             mappings[i:i + chunk_size])
+            session.commit()
+        except Exception:
+            while session.transaction is not None and session.transaction.nested:
+                session.rollback()
+            session.rollback()
+            raise
 
     @staticmethod
     def to_bbg_query(req_ticker, req_yellow_key, req_overrides='UND',
@@ -129,6 +239,11 @@ class DatsProvider(DatsRepoBase):
                                 status.bbg_gethistory_descr) for status in
                 all_status}
 
+    @cached_property
+    def getdata_descs(self):
+        return {code: status.bbg_getdata_descr
+                for code, status in self.list_bbg_return_status.items()}
+
     def get_getdata_desc_of(self, code):
         return self.list_bbg_return_status[code].bbg_getdata_descr
 
@@ -136,14 +251,20 @@ class DatsProvider(DatsRepoBase):
         return self.list_bbg_return_status[code].bbg_gethistory_descr
 
     def save_dats_bbg_request(self, requests):
-        dict_requests = requests.to_dict('records')
-        dict_reqs_lower = [{k.lower(): v for k, v in d.items()}
-                           for d in dict_requests]
-
+        dict_reqs_lower = requests.rename(columns=lambda c: c.lower()) \
+            .to_dict('records')
+        if self._pending_writes is not None:
+            self._buffer_writes(dict_reqs_lower)
+            return
         self._dats_bbg_request_repo_.update_all(dict_reqs_lower)
 
     def update_dats_bbg_request(self, requests, status_to,
                                 bt_request_id, public_msg=None):
+        if self._pending_updates is not None:
+            update = (status_to, bt_request_id, public_msg)
+            for r in requests:
+                self._pending_updates[r.dats_bbg_request_id] = update
+            return
         # apply status to all requests
         request_ids = np.array([r.dats_bbg_request_id for r in requests])
         self._dats_bbg_request_repo_.update(request_ids, status_to,
@@ -163,3 +284,13 @@ class DatsProvider(DatsRepoBase):
             list_by_bt_request_id(status.value, limit).all()
         return requests
 
+    def group_by_bt_request_id(self, status, limit):
+        """
+        Requests in status, grouped in one pass as {bt_request_id: [request]}
+        in bt_request_id order
+        """
+        groups = {}
+        for r in self.get_by_bt_request_id(status, limit):
+            groups.setdefault(r.bt_request_id, []).append(r)
+        return OrderedDict(sorted(groups.items()))
+
@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory file locks on windows, the agents are scheduled on linux
+    fcntl = None
+
+MIN_POLL_INTERVAL = 30
+MAX_POLL_INTERVAL = 15 * 60
+POLL_BACKOFF = 2.0
+LATENCY_HISTORY = 50
+DEFAULT_ETA = {'GETDATA': 2 * 60, 'GETHISTORY': 10 * 60}
+DEFAULT_PROGRAM_ETA = 5 * 60
+MAX_REQUEST_AGE = 2 * 24 * 60 * 60
+
+
+class PollScheduler(object):
+    """
+    Keeps, per bt_request_id, the next time its status is worth checking. The first check is
+    due at the estimated completion time, from the completion latencies seen for the same
+    program code scaled by payload size, and every check that finds the request still
+    pending backs off from MIN_POLL_INTERVAL to MAX_POLL_INTERVAL.
+    State is kept in a json file so it carries over between scheduled runs, and is shared by
+    the REQUEST and POLL agents: save merges this run's changes into the file under a lock.
+    """
+
+    def __init__(self, state_file, clock=time.time):
+        self._state_file = state_file
+        self._clock = clock
+        self._changed = set()
+        self._removed = set()
+        self._new_latencies = {}
+        self._requests, self._latencies = self._load()
+
+    def _load(self):
+        if not os.path.exists(self._state_file):
+            return {}, {}
+        try:
+            with open(self._state_file) as f:
+                state = json.load(f)
+            return state.get('requests', {}), state.get('latencies', {})
+        except (IOError, ValueError) as ex:
+            logging.warning('Ignoring poll schedule {}: {}'.format(self._state_file, ex))
+            return {}, {}
+
+    @contextmanager
+    def _locked(self):
+        with open(self._state_file + '.lock', 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def save(self):
+        """
+        Re-read the state file and write it back with the requests registered, checked and
+        finished and the latencies seen since the last save, so other agents' changes are kept.
+        Requests submitted more than MAX_REQUEST_AGE ago are dropped, they are no longer polled
+        when their rows are deleted or their status was never written
+        """
+        with self._locked():
+            requests, latencies = self._load()
+            for key in self._removed:
+                requests.pop(key, None)
+            for key in self._changed:
+                requests[key] = self._merge_request(requests.get(key), self._requests[key])
+            cutoff = self._clock() - MAX_REQUEST_AGE
+            for key in [k for k, r in requests.items() if r['submitted'] < cutoff]:
+                del requests[key]
+            for program_code, samples in self._new_latencies.items():
+                history = latencies.setdefault(program_code, [])
+                history.extend(samples)
+                del history[:-LATENCY_HISTORY]
+            fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self._state_file)))
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'requests': requests, 'latencies': latencies}, f)
+            os.rename(tmp_file, self._state_file)
+        self._requests, self._latencies = requests, latencies
+        self._changed, self._removed, self._new_latencies = set(), set(), {}
+
+    @staticmethod
+    def _merge_request(saved, request):
+        # a request first seen by a status check takes the submission details from its registration
+        if saved and saved['submitted'] < request['submitted']:
+            return dict(request, submitted=saved['submitted'], program_code=saved['program_code'],
+                        size=saved['size'])
+        return request
+
+    def estimate(self, program_code, size=None):
+        """
+        Expected seconds from submission to completion
+        """
+        history = self._latencies.get(program_code or '')
+        if not history:
+            return DEFAULT_ETA.get(program_code, DEFAULT_PROGRAM_ETA)
+        if size:
+            rates = sorted(latency / s for latency, s in history if s)
+            if rates:
+                return rates[len(rates) // 2] * size
+        latencies = sorted(latency for latency, _ in history)
+        return latencies[len(latencies) // 2]
+
+    def register(self, bt_request_id, program_code=None, size=None, submitted=None):
+        submitted = self._clock() if submitted is None else submitted
+        eta = self.estimate(program_code, size)
+        key = str(bt_request_id)
+        self._requests[key] = {'submitted': submitted,
+                               'program_code': program_code,
+                               'size': size,
+                               'interval': MIN_POLL_INTERVAL,
+                               'last_pending': submitted,
+                               'next_check': submitted + max(eta, MIN_POLL_INTERVAL)}
+        self._changed.add(key)
+        self._removed.discard(key)
+
+    def is_due(self, bt_request_id):
+        request = self._requests.get(str(bt_request_id))
+        return request is None or request['next_check'] <= self._clock()
+
+    def checked(self, bt_request_id, is_completed):
+        """
+        Record a status check, completed requests feed the latency history. A request finished
+        somewhere between its last pending check and this one, the midpoint is taken as its
+        completion time, so the estimate can come down as well as go up.
+        """
+        now = self._clock()
+        key = str(bt_request_id)
+        if key not in self._requests:
+            # submitted before it was registered, nothing to learn from its latency
+            if is_completed:
+                return
+            self.register(key, submitted=now)
+        request = self._requests[key]
+        if is_completed:
+            last_pending = request.get('last_pending', request['submitted'])
+            sample = [last_pending + (now - last_pending) / 2.0 - request['submitted'], request['size']]
+            program_code = request['program_code'] or ''
+            for history in (self._latencies.setdefault(program_code, []),
+                            self._new_latencies.setdefault(program_code, [])):
+                history.append(sample)
+                del history[:-LATENCY_HISTORY]
+            self.forget(key)
+            return
+        request['last_pending'] = now
+        request['next_check'] = now + request['interval']
+        request['interval'] = min(request['interval'] * POLL_BACKOFF, MAX_POLL_INTERVAL)
+        self._changed.add(key)
+
+    def forget(self, bt_request_id):
+        key = str(bt_request_id)
+        self._requests.pop(key, None)
+        self._changed.discard(key)
+        self._removed.add(key)
@@ -0,0 +1,151 @@
+import random
+from collections import defaultdict
+
+import mock
+import pytest
+import requests
+
+from ju.bt_client import BtClient, ShardedResponse, Shard, ITEM_OVERHEAD_BYTES, pack_requests
+from ju.dats_config import BbgTransportForbidden
+from etl.core.util import struct
+
+
+def make_request(i, mnemonic='PX_LAST', ticker=None, yellow_key='Equity'):
+    return struct(dats_bbg_request_id=i, req_ticker=ticker or 'T{}'.format(i), req_yellow_key=yellow_key,
+                  req_mnemonic=mnemonic, req_overrides=None, req_optional_elements=None)
+
+
+@pytest.fixture(name='x_config')
+def config_fixture():
+    config = mock.Mock(bt_endpoint='http://bt/', bt_req_code='DATS', bt_request_items={}, program_code='GETDATA',
+                       shard_max_items=2, shard_max_bytes=10 ** 6, pack_overhead_cells=0, http_pool_size=4,
+                       http_timeout=5, http_retries=0, compress_upload=False)
+    config.get_mandatory_mnemonics.return_value = ['ID_BB_GLOBAL']
+    config.bt_error_status.return_value = ['ERROR']
+    config.bt_complete_status.return_value = ['SUCCESS']
+    return config
+
+
+@pytest.mark.parametrize('max_items, max_bytes, x_sizes', [
+    (2, 10 ** 6, [2, 2, 1]),
+    (10, 2 * (2 + len('Equity') + ITEM_OVERHEAD_BYTES), [2, 2, 1]),
+    (10, 10 ** 6, [5]),
+    (1, 0, [1, 1, 1, 1, 1])
+])
+def test_shard(x_config, max_items, max_bytes, x_sizes):
+    x_config.shard_max_items, x_config.shard_max_bytes = max_items, max_bytes
+    shards = BtClient(x_config)._shard([make_request(i) for i in range(5)])
+    assert [len(s) for s in shards] == x_sizes
+    assert [r.dats_bbg_request_id for s in shards for r in s] == list(range(5))
+
+
+def test_shard_null_yellow_key(x_config):
+    assert [len(s) for s in BtClient(x_config)._shard([make_request(i, yellow_key=None) for i in range(3)])] == [2, 1]
+
+
+def test_shard_no_requests(x_config):
+    assert BtClient(x_config)._shard([]) == [[]]
+
+
+def test_sharded_response():
+    response = ShardedResponse([Shard(requests=[1], response={'request_id': 'BT1'}, metrics=None, error=None),
+                                Shard(requests=[2], response={'request_id': 'BT2', 'is_error': True}, metrics=None,
+                                      error=None),
+                                Shard(requests=[3], response=None, metrics=None, error=ValueError('post failed'))])
+    assert response.request_ids == ['BT1', 'BT2']
+    assert [s.requests for s in response.good_shards] == [[1]]
+    assert [str(e) for e in response.errors] == ['post failed']
+
+
+def post_by_first_request(payload, metrics=None):
+    metrics.raw_bytes = len(payload)
+    if payload[0] == 2:
+        raise requests.HTTPError(response=mock.Mock(status_code=403, text='denied'))
+    if payload[0] == 4:
+        raise RuntimeError('connection reset')
+    if payload[0] == 6:
+        raise requests.HTTPError(response=mock.Mock(status_code=500, text='down'))
+    return {'request_id': 'BT{}'.format(payload[0]), 'request_status': 'PENDING'}
+
+
+def test_post_keeps_posted_shards_when_one_fails(mocker, x_config):
+    mocker.patch('ju.bt_client.pack_requests', side_effect=lambda req, fields, cells: [req])
+    mocker.patch.object(BtClient, 'get_request_item',
+                        side_effect=lambda req, ps, metrics: mock.Mock(
+                            to_json=lambda: [r.dats_bbg_request_id for r in req]))
+    x_post = mocker.patch.object(BtClient, '_post', side_effect=post_by_first_request)
+    response = BtClient(x_config).post([make_request(i) for i in range(8)])
+    assert x_post.call_count == 4
+    # the posted shard comes back with the failed ones, a 500 leaves its shard without a response or error
+    assert response.request_ids == ['BT0']
+    assert [[r.dats_bbg_request_id for r in s.requests] for s in response.good_shards] == [[0, 1]]
+    assert [type(e) for e in response.errors] == [BbgTransportForbidden, RuntimeError]
+
+
+def pack_requests_pairwise(requests, fixed_fields, overhead_cells):
+    """
+    pack_requests as a scan of every pair per merge, the greedy choice pack_requests must reproduce
+    """
+    fixed_fields = frozenset(fixed_fields)
+    by_security = defaultdict(list)
+    for r in requests:
+        by_security[(r.req_ticker, r.req_yellow_key, r.req_overrides, r.req_optional_elements)].append(r)
+    by_mnemonics = defaultdict(list)
+    for rows in by_security.values():
+        by_mnemonics[frozenset(r.req_mnemonic for r in rows)].extend(rows)
+    groups = by_mnemonics.items()
+    while len(groups) > 1:
+        best = None
+        for i in range(len(groups)):
+            for j in range(i + 1, len(groups)):
+                (mi, ri), (mj, rj) = groups[i], groups[j]
+                saving = len(ri) * len(mi | fixed_fields) + len(rj) * len(mj | fixed_fields) + overhead_cells - \
+                    (len(ri) + len(rj)) * len(mi | mj | fixed_fields)
+                if saving >= 0 and (best is None or saving > best[0]):
+                    best = (saving, i, j)
+        if best is None:
+            break
+        _, i, j = best
+        groups[i] = (groups[i][0] | groups[j][0], groups[i][1] + groups[j][1])
+        del groups[j]
+    return [rows for _, rows in groups]
+
+
+def make_security_requests(ticker, mnemonics, start):
+    return [make_request(start + i, mnemonic=m, ticker=ticker) for i, m in enumerate(mnemonics)]
+
+
+def group_ids(groups):
+    return sorted(sorted(r.dats_bbg_request_id for r in g) for g in groups)
+
+
+@pytest.mark.parametrize('overhead_cells, x_groups', [
+    (0, [[0, 1, 2, 3], [4, 5, 6], [7]]),
+    (2, [[0, 1, 2, 3, 7], [4, 5, 6]]),
+    (10 ** 6, [list(range(8))])
+])
+def test_pack_requests(overhead_cells, x_groups):
+    requests = make_security_requests('A', ['PX_LAST', 'NAME'], 0) + \
+        make_security_requests('B', ['NAME', 'PX_LAST'], 2) + \
+        make_security_requests('C', ['PX_LAST', 'NAME', 'CRNCY'], 4) + \
+        make_security_requests('D', ['PX_LAST'], 7)
+    assert group_ids(pack_requests(requests, ['ID_BB_GLOBAL'], overhead_cells)) == x_groups
+
+
+def test_pack_requests_too_many_sets(mocker):
+    mocker.patch('ju.bt_client.MAX_PACK_GROUPS', 2)
+    requests = [make_request(i, mnemonic='F{}'.format(i)) for i in range(3)]
+    assert pack_requests(requests, [], 0) == [requests]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_pack_requests_matches_pairwise_scan(seed):
+    rnd = random.Random(seed)
+    mnemonics = ['F{}'.format(i) for i in range(8)]
+    requests = []
+    for s in range(rnd.randint(1, 60)):
+        requests.extend(make_security_requests('T{}'.format(s), rnd.sample(mnemonics, rnd.randint(1, 4)),
+                                               len(requests)))
+    overhead_cells = rnd.choice([0, 1, 5, 20, 100])
+    assert [[r.dats_bbg_request_id for r in g] for g in pack_requests(requests, ['ID'], overhead_cells)] == \
+        [[r.dats_bbg_request_id for r in g] for g in pack_requests_pairwise(requests, ['ID'], overhead_cells)]
@@ -0,0 +1,45 @@
+import mock
+
+from ju.config_cache import ConfigCache, get_etl_config, config_cache
+from etl.core.util import struct
+
+
+class Clock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_get_reloads_after_ttl():
+    clock = Clock()
+    cache = ConfigCache(ttl=60, clock=clock)
+    load = mock.Mock(side_effect=['v1', 'v2'])
+    assert cache.get('K', load) == 'v1'
+    clock.now += 60
+    assert cache.get('K', load) == 'v1'
+    clock.now += 1
+    assert cache.get('K', load) == 'v2'
+    assert load.call_count == 2
+
+
+def test_invalidate():
+    cache = ConfigCache(ttl=60, clock=Clock())
+    cache.get('K1', lambda: 'v1')
+    cache.get('K2', lambda: 'v2')
+    cache.invalidate('K1')
+    assert cache.get('K1', lambda: 'v1b') == 'v1b'
+    assert cache.get('K2', lambda: 'v2b') == 'v2'
+    cache.invalidate()
+    assert cache.get('K2', lambda: 'v2c') == 'v2c'
+
+
+def test_get_etl_config(mocker):
+    x_repo = mocker.patch('ju.config_cache.EtlConfigRepo')
+    x_repo.instance.list_all.return_value = [struct(config_code='DATS_BT_REQ_CODE', config_value='DATS')]
+    config_cache.invalidate()
+    assert get_etl_config('DATS_BT_REQ_CODE').config_value == 'DATS'
+    assert get_etl_config('MISSING') is None
+    assert x_repo.instance.list_all.call_count == 1
+    config_cache.invalidate()
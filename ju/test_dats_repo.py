@@ -0,0 +1,79 @@
+import pandas as pd
+import pytest
+
+from ju.dats_repo import DatsProvider
+from etl.core.util import struct
+
+ERROR, VALID = struct(value='ERROR'), struct(value='VALID')
+REQUESTS = [struct(dats_bbg_request_id=i) for i in range(4)]
+
+
+@pytest.fixture(name='x_repo')
+def repo_fixture(mocker):
+    x_repo = mocker.Mock()
+    x_repo.db.session.transaction.nested = False
+    mocker.patch.object(DatsProvider, '_dats_bbg_request_repo_', new_callable=mocker.PropertyMock,
+                        return_value=x_repo)
+    return x_repo
+
+
+def test_bulk_writes_merges_saves_per_row(x_repo):
+    provider = DatsProvider()
+    with provider.bulk_writes(chunk_size=2):
+        provider.save_dats_bbg_request(pd.DataFrame({'DATS_BBG_REQUEST_ID': [1, 2, 3], 'BBG_NAME': ['A', 'B', 'C']}))
+        provider.save_dats_bbg_request(pd.DataFrame({'DATS_BBG_REQUEST_ID': [1], 'BBG_NAME': ['A2'],
+                                                     'PUBLIC_MSG': ['ok']}))
+        assert not x_repo.db.session.bulk_update_mappings.called
+    chunks = [c[0][1] for c in x_repo.db.session.bulk_update_mappings.call_args_list]
+    assert [len(c) for c in chunks] == [2, 1]
+    assert sorted((m['dats_bbg_request_id'], m['bbg_name'], m.get('public_msg')) for c in chunks for m in c) == [
+        (1, 'A2', 'ok'), (2, 'B', None), (3, 'C', None)]
+    assert x_repo.db.session.commit.call_count == 1
+    assert not x_repo.update_all.called
+
+
+def test_bulk_writes_updates_status_through_repo(mocker, x_repo):
+    mocker.patch('ju.dats_repo.IN_LIST_SIZE', 2)
+    provider = DatsProvider()
+    with provider.bulk_writes():
+        provider.update_dats_bbg_request(REQUESTS, ERROR, 'BT1', 'BT Request Id BT1 is not found')
+        provider.update_dats_bbg_request(REQUESTS[1:2], VALID, 'BT1')
+        assert not x_repo.update.called
+    assert x_repo.update.call_args_list == [mocker.call([0, 2], ERROR, 'BT1', 'BT Request Id BT1 is not found'),
+                                            mocker.call([3], ERROR, 'BT1', 'BT Request Id BT1 is not found'),
+                                            mocker.call([1], VALID, 'BT1', None)]
+    assert x_repo.db.session.begin_nested.call_count == 3
+    assert x_repo.db.session.commit.call_count == 1
+
+
+def test_bulk_writes_rolls_back(x_repo):
+    x_repo.db.session.bulk_update_mappings.side_effect = RuntimeError('ORA-00001')
+    provider = DatsProvider()
+    with pytest.raises(RuntimeError):
+        with provider.bulk_writes():
+            provider.update_dats_bbg_request(REQUESTS[:1], ERROR, 'BT1')
+            provider.save_dats_bbg_request(pd.DataFrame({'DATS_BBG_REQUEST_ID': [2], 'BBG_NAME': ['B']}))
+    assert not x_repo.db.session.commit.called
+    assert x_repo.db.session.rollback.call_count == 1
+
+
+def test_bulk_writes_drops_buffers_when_block_raises(x_repo):
+    provider = DatsProvider()
+    with pytest.raises(ValueError):
+        with provider.bulk_writes():
+            provider.update_dats_bbg_request(REQUESTS[:1], ERROR, 'BT1')
+            raise ValueError('no response rows')
+    assert not x_repo.update.called
+    assert not x_repo.db.session.bulk_update_mappings.called
+    assert not x_repo.db.session.commit.called
+    provider.update_dats_bbg_request(REQUESTS[:1], ERROR, 'BT1')
+    assert x_repo.update.call_count == 1
+
+
+def test_writes_without_bulk_block(x_repo):
+    provider = DatsProvider()
+    provider.update_dats_bbg_request(REQUESTS[:2], ERROR, 'BT1')
+    provider.save_dats_bbg_request(pd.DataFrame({'DATS_BBG_REQUEST_ID': [2], 'BBG_NAME': ['B']}))
+    (request_ids, status_to, bt_request_id, public_msg), _ = x_repo.update.call_args
+    assert (list(request_ids), status_to, bt_request_id, public_msg) == ([0, 1], ERROR, 'BT1', None)
+    x_repo.update_all.assert_called_once_with([{'dats_bbg_request_id': 2, 'bbg_name': 'B'}])
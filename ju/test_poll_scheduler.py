@@ -0,0 +1,121 @@
+import json
+
+import pytest
+
+from ju.poll_scheduler import PollScheduler, DEFAULT_ETA, MIN_POLL_INTERVAL, MAX_POLL_INTERVAL, MAX_REQUEST_AGE
+
+
+class Clock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(name='x_state_file')
+def state_file_fixture(tmpdir):
+    return str(tmpdir.join('poll_schedule.json'))
+
+
+def test_first_check_at_estimate_then_backoff(x_state_file):
+    clock = Clock()
+    scheduler = PollScheduler(x_state_file, clock=clock)
+    scheduler.register('BT1', 'GETDATA')
+    assert not scheduler.is_due('BT1')
+    clock.now += DEFAULT_ETA['GETDATA']
+    assert scheduler.is_due('BT1')
+    intervals = []
+    for _ in range(8):
+        scheduler.checked('BT1', False)
+        start = clock.now
+        while not scheduler.is_due('BT1'):
+            clock.now += 1
+        intervals.append(clock.now - start)
+    assert intervals[:3] == [MIN_POLL_INTERVAL, MIN_POLL_INTERVAL * 2, MIN_POLL_INTERVAL * 4]
+    assert intervals[-1] == MAX_POLL_INTERVAL
+
+
+def test_unknown_request_is_due(x_state_file):
+    assert PollScheduler(x_state_file, clock=Clock()).is_due('BT1')
+
+
+def test_estimate_learns_faster_completions(x_state_file):
+    clock = Clock()
+    scheduler = PollScheduler(x_state_file, clock=clock)
+    estimates = []
+    for i in range(5):
+        scheduler.register(i, 'GETDATA')
+        estimates.append(scheduler.estimate('GETDATA'))
+        # done by the first check, at the estimated completion time
+        clock.now += estimates[-1]
+        scheduler.checked(i, True)
+    assert estimates == sorted(estimates, reverse=True)
+    assert estimates[-1] < DEFAULT_ETA['GETDATA']
+
+
+def test_latency_is_midpoint_of_last_pending_check(x_state_file):
+    clock = Clock()
+    scheduler = PollScheduler(x_state_file, clock=clock)
+    scheduler.register('BT1', 'GETHISTORY', size=100)
+    clock.now += 600
+    scheduler.checked('BT1', False)
+    clock.now += 30
+    scheduler.checked('BT1', True)
+    assert scheduler.estimate('GETHISTORY') == 615
+    assert scheduler.estimate('GETHISTORY', size=200) == pytest.approx(1230)
+
+
+def test_unregistered_completed_request_is_not_learnt(x_state_file):
+    scheduler = PollScheduler(x_state_file, clock=Clock())
+    scheduler.checked('BT1', True)
+    assert scheduler.estimate('GETDATA') == DEFAULT_ETA['GETDATA']
+
+
+def test_save_merges_agents_changes(x_state_file):
+    clock = Clock()
+    seed = PollScheduler(x_state_file, clock=clock)
+    seed.register('DONE', 'GETDATA')
+    seed.register('STALE', 'GETDATA')
+    seed.save()
+    request_agent = PollScheduler(x_state_file, clock=clock)
+    poll_agent = PollScheduler(x_state_file, clock=clock)
+    request_agent.register('NEW', 'GETHISTORY', size=10)
+    request_agent.save()
+    clock.now += 60
+    poll_agent.checked('DONE', True)
+    poll_agent.forget('STALE')
+    # the poll agent loaded the file before NEW was registered and finds it pending
+    poll_agent.checked('NEW', False)
+    poll_agent.save()
+    with open(x_state_file) as f:
+        state = json.load(f)
+    assert sorted(state['requests']) == ['NEW']
+    assert state['requests']['NEW']['program_code'] == 'GETHISTORY'
+    assert state['requests']['NEW']['next_check'] == clock.now + MIN_POLL_INTERVAL
+    assert [s[0] for s in state['latencies']['GETDATA']] == [30]
+    assert not PollScheduler(x_state_file, clock=clock).is_due('NEW')
+
+
+def test_save_drops_old_requests(x_state_file):
+    clock = Clock()
+    scheduler = PollScheduler(x_state_file, clock=clock)
+    scheduler.register('LOST', 'GETDATA')
+    scheduler.save()
+    clock.now += MAX_REQUEST_AGE
+    scheduler = PollScheduler(x_state_file, clock=clock)
+    scheduler.register('NEW', 'GETDATA')
+    scheduler.save()
+    clock.now += 1
+    PollScheduler(x_state_file, clock=clock).save()
+    with open(x_state_file) as f:
+        assert sorted(json.load(f)['requests']) == ['NEW']
+
+
+def test_corrupt_state_file_is_ignored(x_state_file):
+    with open(x_state_file, 'w') as f:
+        f.write('{not json')
+    scheduler = PollScheduler(x_state_file, clock=Clock())
+    scheduler.register('BT1', 'GETDATA')
+    scheduler.save()
+    assert not PollScheduler(x_state_file, clock=Clock()).is_due('BT1')
@@ -0,0 +1,97 @@
+import random
+
+import pandas as pd
+import pytest
+
+from ju.bt_client import ShardedResponse, Shard
+from ju.dats_config import BbgTransportForbidden
+from ju.poll_scheduler import PollScheduler
+from ju.validator import ValidatorRequestAgent, ValidationUtility, DatsBbgRequestStatusEnum
+from etl.core.util import struct
+
+
+@pytest.fixture(name='x_schedule_file')
+def schedule_file_fixture(mocker, tmpdir):
+    schedule_file = str(tmpdir.join('poll_schedule.json'))
+    mocker.patch('ju.validator.POLL_SCHEDULE_FILE', schedule_file)
+    return schedule_file
+
+
+def test_request_agent_stamps_posted_shards_before_raising(mocker, x_schedule_file):
+    x_config = mocker.patch('ju.validator.ValidatorConfig').return_value
+    x_config.log_level, x_config.program_code = 'INFO', 'GETDATA'
+    requests = [struct(dats_bbg_request_id=i) for i in range(4)]
+    agent = ValidatorRequestAgent()
+    agent._provider = mocker.Mock()
+    agent._provider.list_dats_bbg_request_by_status.side_effect = lambda status, limit, ps: requests if ps else []
+    agent._bt_client = mocker.Mock()
+    agent._bt_client.post.return_value = ShardedResponse([
+        Shard(requests=requests[:2], response={'request_id': 'BT1'}, metrics=struct(raw_bytes=100), error=None),
+        Shard(requests=requests[2:], response=None, metrics=struct(raw_bytes=None),
+              error=BbgTransportForbidden('Forbidden'))])
+    with pytest.raises(BbgTransportForbidden):
+        with agent.execute():
+            pass
+    agent._provider.update_dats_bbg_request.assert_called_once_with(requests[:2], DatsBbgRequestStatusEnum.PENDING,
+                                                                    'BT1')
+    assert not PollScheduler(x_schedule_file).is_due('BT1')
+
+
+def validate_chain(bbg_df, getdata_descs):
+    """
+    The validation as a chain of per-check passes, the outcome ValidationUtility.validate must reproduce
+    """
+    invalid, valid = DatsBbgRequestStatusEnum.INVALID.value, DatsBbgRequestStatusEnum.VALID.value
+    row_status = bbg_df.BBG_ROW_STATUS.astype(int)
+    bbg_df.loc[row_status != 0, 'STATUS'] = invalid
+    bbg_df.loc[row_status != 0, 'public_msg'] = row_status[row_status != 0].apply(lambda r: getdata_descs[r])
+    bbg_df.loc[bbg_df.return_val == 'FLD UNKNOWN', 'STATUS'] = invalid
+    bbg_df.loc[bbg_df.return_val == 'FLD UNKNOWN', 'public_msg'] = 'Invalid BBG Mnemonic'
+    where = (bbg_df.STATUS != invalid) & (bbg_df.req_yellow_key != bbg_df.BBG_MARKET_SECTOR_DES)
+    bbg_df.loc[where, 'STATUS'] = invalid
+    bbg_df.loc[where, 'public_msg'] = 'Requested yellow is not matching with bbg return yellow key'
+    where = (bbg_df.STATUS != invalid) & (bbg_df.BBG_PRICING_SOURCE != '') & \
+        (bbg_df.req_pricing_source != bbg_df.BBG_PRICING_SOURCE)
+    bbg_df.loc[where, 'STATUS'] = invalid
+    bbg_df.loc[where, 'public_msg'] = 'Requested pricing source is different from bbg return pricing source'
+    bbg_df.loc[bbg_df.STATUS != invalid, 'STATUS'] = valid
+    bbg_df.loc[bbg_df.STATUS == valid, 'public_msg'] = 'Series successfully processed'
+
+
+GETDATA_DESCS = {0: 'Valid', 9: 'Unknown security', 10: None}
+
+
+def make_polled_rows(rnd, n):
+    return pd.DataFrame({'return_val': [rnd.choice(['1.5', 'FLD UNKNOWN']) for _ in range(n)],
+                         'BBG_ROW_STATUS': [rnd.choice(['0', '0', '9', '10']) for _ in range(n)],
+                         'req_yellow_key': [rnd.choice(['Equity', 'Corp']) for _ in range(n)],
+                         'BBG_MARKET_SECTOR_DES': [rnd.choice(['Equity', 'Corp']) for _ in range(n)],
+                         'req_pricing_source': [rnd.choice([None, 'BGN', 'CBBT']) for _ in range(n)],
+                         'BBG_PRICING_SOURCE': [rnd.choice(['', 'BGN', 'CBBT']) for _ in range(n)],
+                         'req_is_register_series': [rnd.choice([0, 1]) for _ in range(n)],
+                         'STATUS': DatsBbgRequestStatusEnum.PENDING.value})
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_validate_matches_check_chain(seed):
+    bbg_df = make_polled_rows(random.Random(seed), 500)
+    expected = bbg_df.copy()
+    validate_chain(expected, GETDATA_DESCS)
+    ValidationUtility.validate(bbg_df, GETDATA_DESCS)
+    assert list(bbg_df.STATUS) == list(expected.STATUS)
+    assert list(bbg_df.public_msg) == list(expected.public_msg)
+
+
+def test_validate_null_description():
+    bbg_df = make_polled_rows(random.Random(0), 1)
+    bbg_df['return_val'], bbg_df['BBG_ROW_STATUS'] = '1.5', '10'
+    ValidationUtility.validate(bbg_df, GETDATA_DESCS)
+    assert list(bbg_df.STATUS) == [DatsBbgRequestStatusEnum.INVALID.value]
+    assert list(bbg_df.public_msg) == [None]
+
+
+def test_validate_unknown_return_status():
+    bbg_df = make_polled_rows(random.Random(0), 3)
+    bbg_df['BBG_ROW_STATUS'] = ['0', '11', '9']
+    with pytest.raises(KeyError):
+        ValidationUtility.validate(bbg_df, GETDATA_DESCS)
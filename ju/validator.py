@@ -2,8 +2,10 @@ import abc
 import logging
 import os
 import sys
+import tempfile
 from collections import namedtuple
 from contextlib import contextmanager
+from operator import attrgetter
 
 import numpy as np
 import pandas as pd
@@ -12,6 +14,7 @@ from bt_client import BtClient
 from dats_config import DatsBtClientConfig as ValidatorConfig, \
     BbgTransportErrorStatus, BbgTransport404Status
 from dats_repo import DatsProvider, DatsBbgRequest
+from poll_scheduler import PollScheduler
 from etl.core.timed import timed
 from etl.core.util import parse_args
 from etl.enum.pim_da.gen.dats_bbg_request_status import DatsBbgRequestStatusEnum
@@ -19,7 +22,9 @@ from etl.enum.pim_da.gen.dats_bbg_request_status import DatsBbgRequestStatusEnum
 USAGE = ['DATS BBG Validate', ['direction', {'help': 'REQUEST or POLL'}]]
 HEADER_PREFIX = 'BBG_'
 HAS_PRICING_SOURCES = [True, False]
+POLL_SCHEDULE_FILE = os.path.join(tempfile.gettempdir(), 'dats_validator_poll_schedule.json')
 Status = namedtuple('Status', ['bt_request_id', 'result'])
+Rule = namedtuple('Rule', ['name', 'status', 'applies', 'public_msg'])
 
 
 class ValidatorAgent:
@@ -33,6 +38,7 @@ class ValidatorAgent:
         self._request_limit = self._config.get_cfg_dict_by_key(req_limit_key)
         self._provider = None
         self._bt_client = None
+        self._poll_scheduler = None
         self._requests = None
         self._result = ValidatorConfig.NO_ITEMS_PROCESSED
 
@@ -58,21 +64,29 @@ class ValidatorAgent:
             self._provider = DatsProvider()
         return self._provider
 
+    @property
+    def poll_scheduler(self):
+        if self._poll_scheduler is None:
+            self._poll_scheduler = PollScheduler(POLL_SCHEDULE_FILE)
+        return self._poll_scheduler
+
     @abc.abstractmethod
     def get_requests_from_db(self, get_pricing_source):
         pass
 
-    def update_requests(self, status_to, bt_request_id=None):
+    def update_requests(self, status_to, bt_request_id=None, requests=None):
         """
         Update the Request table with the response from BT
         :param status_to:
         :param bt_request_id:
+        :param requests: defaults to all the requests retrieved
         :return:
         """
         try:
             logging.info('Updating request status in DB')
-            self.provider.update_dats_bbg_request(self._requests, status_to,
-                                                  bt_request_id)
+            self.provider.update_dats_bbg_request(
+                self._requests if requests is None else requests, status_to,
+                bt_request_id)
         except Exception as err:
             logging.exception(
                 'Error at ValidatorRequestAgent.update_requests: ' +
@@ -97,21 +111,32 @@ class ValidatorRequestAgent(ValidatorAgent):
     @contextmanager
     def execute(self):
         """
-        Retrieve new request from DB, submit request to BT, update status
+        Retrieve new request from DB, submit request to BT, update status.
+        Shards that failed to post stay NEW, their errors are raised once the
+        posted shards are PENDING
         :return:
         """
+        errors = []
         for ps in HAS_PRICING_SOURCES:
             self.get_requests_from_db(ps)
             if self.is_requests_found:
                 self.submit_request(ps)
-                if self.is_response_good:
+                if self._response:
+                    errors.extend(self._response.errors)
+                for shard in self.good_shards:
                     logging.info('Successfully submitted')
+                    self.poll_scheduler.register(shard.response['request_id'],
+                                                 self._config.program_code,
+                                                 shard.metrics.raw_bytes)
                     is_done = self.update_requests(
                         DatsBbgRequestStatusEnum.PENDING,
-                        self._response['request_id'])
+                        shard.response['request_id'], shard.requests)
                     if is_done:
                         logging.info('Successfully updated')
                         self._result = ValidatorConfig.ITEMS_PROCESSED
+                self.poll_scheduler.save()
+        if errors:
+            raise errors[0]
         yield self._result
 
     def get_requests_from_db(self, has_pricing_source):
@@ -133,8 +158,8 @@ class ValidatorRequestAgent(ValidatorAgent):
             logging.exception(err.message)
 
     @property
-    def is_response_good(self):
-        return self._response and not self._response.get('is_error')
+    def good_shards(self):
+        return self._response.good_shards if self._response else []
 
     @property
     def is_requests_found(self):
@@ -145,6 +170,7 @@ class ValidatorRequestAgent(ValidatorAgent):
         Call BBG Transport, add to BT request queue
         :return:
         """
+        self._response = None
         try:
             logging.info('Submitting validation requests to BBG Transport..')
             self._response = self.bt_client.post(self._requests,
@@ -162,7 +188,8 @@ class ValidatorPollingAgent(ValidatorAgent):
 
         # current bt_request_id
         self._bt_request_id = None
-        # _current_requests is a subset of self._requests for the bt_request_id
+        # _requests is {bt_request_id: [request]} and _current_requests the
+        # group of the bt_request_id being processed
         self._current_requests = None
 
         self._status_list = []
@@ -183,11 +210,24 @@ class ValidatorPollingAgent(ValidatorAgent):
         if bt_request_ids is None:
             yield self._result
         else:
-            self.process_each_request(bt_request_ids)
+            try:
+                # every status and validation result of the cycle goes to the
+                # DB in one transaction when the block ends, none if it raises
+                with self.provider.bulk_writes(self._config.bulk_chunk_size):
+                    self.process_each_request(bt_request_ids)
+            except Exception as err:
+                logging.exception('Error processing the poll results: ' +
+                                  err.message)
+                self._result = ValidatorConfig.NO_ITEMS_PROCESSED
+            self.poll_scheduler.save()
             yield self._result
 
     def process_each_request(self, bt_request_ids):
         for each_request_id in bt_request_ids:
+            if not self.poll_scheduler.is_due(each_request_id):
+                logging.info('Skipping {bt_id}, not due for a status check'
+                             .format(bt_id=each_request_id))
+                continue
             self.set_working_batch(each_request_id)
             self.transform_request_to_df()
             try:
@@ -204,8 +244,7 @@ class ValidatorPollingAgent(ValidatorAgent):
     def set_working_batch(self, each_request_id):
         # reset _bt_request_id, _requests to per req. item
         self.set_bt_request_id(each_request_id)
-        self._current_requests = [r for r in self._requests
-                                  if r.bt_request_id == each_request_id]
+        self._current_requests = self._requests[each_request_id]
 
     def add_to_result_list(self, bt_request_id, is_success):
         logging.info('Adding Validation Result for {bt_request_id}: [{result}]'
@@ -221,34 +260,22 @@ class ValidatorPollingAgent(ValidatorAgent):
         try:
             logging.info(
                 'Retrieving requests from DATS_BBG_REQUEST table..')
-            requests = self.provider \
-                .get_by_bt_request_id(self._processing_status,
-                                      self._request_limit)
-            self._requests = requests
-            return self.get_unique_request_ids(self._requests)
+            self._requests = self.provider \
+                .group_by_bt_request_id(self._processing_status,
+                                        self._request_limit)
+            if self._requests:
+                return self._requests.keys()
         except Exception as err:
             logging.exception(err.message)
 
-    @staticmethod
-    def get_unique_request_ids(requests):
-        if requests:
-            return np.unique([r.bt_request_id for r in requests])
-
     def transform_request_to_df(self):
-        reqs = [DatsBbgRequest(dats_bbg_request_id=r.dats_bbg_request_id,
-                               dats_bbg_request_status_code=r.dats_bbg_request_status_code,
-                               req_ticker=r.req_ticker,
-                               req_yellow_key=r.req_yellow_key,
-                               req_mnemonic=r.req_mnemonic,
-                               req_bbg_interface_code=r.req_bbg_interface_code,
-                               req_pricing_source=r.req_pricing_source,
-                               req_overrides=r.req_overrides,
-                               req_optional_elements=r.req_optional_elements,
-                               req_tag=r.req_tag,
-                               req_is_register_series=r.req_is_register_series,
-                               bt_request_id=r.bt_request_id).to_dict()
-                for r in self._current_requests]
-        self._request_df = pd.DataFrame.from_records(reqs)
+        self._request_df = self.requests_to_df(self._current_requests)
+
+    @staticmethod
+    def requests_to_df(requests):
+        return pd.DataFrame.from_records(
+            map(attrgetter(*DatsBbgRequest.COLUMNS), requests),
+            columns=DatsBbgRequest.COLUMNS)
 
     def has_data_from_bt(self):
         try:
@@ -256,7 +283,9 @@ class ValidatorPollingAgent(ValidatorAgent):
             logging.info('Checking status for {bt_id}...'
                          .format(bt_id=self._bt_request_id))
             response = self.bt_client.get(url=status_url)
-            if self.is_completed(response):
+            is_completed = self.is_completed(response)
+            self.poll_scheduler.checked(self._bt_request_id, is_completed)
+            if is_completed:
                 self.bt_client.handle_response(response)
                 response_url = self.bt_client.get_response_url(
                     self._bt_request_id)
@@ -267,6 +296,7 @@ class ValidatorPollingAgent(ValidatorAgent):
                 self.read_and_build_dataframe(resp)
         except BbgTransport404Status as ex404:
             logging.error('Not Found: ' + ex404.message)
+            self.poll_scheduler.forget(self._bt_request_id)
             self.provider.update_dats_bbg_request(self._current_requests,
                                                   DatsBbgRequestStatusEnum.ERROR,
                                                   self._bt_request_id,
@@ -274,6 +304,7 @@ class ValidatorPollingAgent(ValidatorAgent):
                                                       self._bt_request_id))
         except BbgTransportErrorStatus as ex:
             logging.error('BT or BBG error: ' + ex.message)
+            self.poll_scheduler.forget(self._bt_request_id)
             self.provider.update_dats_bbg_request(self._current_requests,
                                                   DatsBbgRequestStatusEnum.ERROR,
                                                   self._bt_request_id,
@@ -308,11 +339,16 @@ class ValidatorPollingAgent(ValidatorAgent):
     @staticmethod
     def find_mnemonic_value(request_df):
         # find the right column to look at the value of mnemonic
-        request_df['col_no'] = request_df['req_mnemonic'].apply(
-            lambda r: request_df.columns.get_loc(HEADER_PREFIX + r))
-        # get the right mnemonic value and fill in 'return_val' column
-        for i, w in request_df['col_no'].iteritems():
-            request_df.loc[i, 'return_val'] = request_df.iloc[i, w]
+        mnemonic_cols = HEADER_PREFIX + request_df['req_mnemonic']
+        request_df['col_no'] = request_df.columns.get_indexer(mnemonic_cols)
+        missing = mnemonic_cols[request_df['col_no'] < 0]
+        if len(missing):
+            raise KeyError(missing.iloc[0])
+        # gather each row's mnemonic value from the BBG_ columns requested
+        lookup_cols = mnemonic_cols.unique()
+        lookup_no = pd.Index(lookup_cols).get_indexer(mnemonic_cols)
+        request_df['return_val'] = request_df[lookup_cols].values[
+            np.arange(len(request_df)), lookup_no]
 
     @staticmethod
     def join_request_and_response_df(request_df, bbg_series):
@@ -340,17 +376,9 @@ class ValidatorPollingAgent(ValidatorAgent):
         """
         try:
             logging.info('Validating...')
-            logging.info('Validating for INVALID status...')
-            df = self._request_df
-            ValidationUtility.validate_identifier(df,
-                                                  self.provider.get_getdata_desc_of)
-            ValidationUtility.validate_mnemonic(df)
-            ValidationUtility.validate_yellow_key(df)
-            ValidationUtility.validate_pricing_source(df)
-            logging.info('Validating for ONHOLD_REG status...')
-            ValidationUtility.update_onhold_reg_status(df)
+            ValidationUtility.validate(self._request_df,
+                                       self.provider.getdata_descs)
             logging.info('Validation finished...')
-            ValidationUtility.update_validated_status(df)
             return True
         except Exception as err:
             logging.error('ValidatorPollingAgent.validate(): ' + err.message)
@@ -389,72 +417,58 @@ class ValidatorPollingAgent(ValidatorAgent):
 
 
 class ValidationUtility:
+    INVALID = DatsBbgRequestStatusEnum.INVALID.value
+    VALID = DatsBbgRequestStatusEnum.VALID.value
+    VALID_MSG = 'Series successfully processed'
+
+    # priority order, a row takes the STATUS and public_msg of the first rule
+    # it matches and VALID when it matches none
+    RULES = [
+        Rule('mnemonic', INVALID,
+             lambda df, ctx: df['return_val'] == 'FLD UNKNOWN',
+             'Invalid BBG Mnemonic'),
+        Rule('identifier', INVALID,
+             lambda df, ctx: ctx['row_status'] != 0,
+             lambda df, ctx: ctx['row_status_desc']),
+        Rule('yellow_key', INVALID,
+             lambda df, ctx: df['req_yellow_key'] != df['BBG_MARKET_SECTOR_DES'],
+             'Requested yellow is not matching with bbg return yellow key'),
+        Rule('pricing_source', INVALID,
+             lambda df, ctx: (df['BBG_PRICING_SOURCE'] != '') &
+                             (df['req_pricing_source'] != df['BBG_PRICING_SOURCE']),
+             'Requested pricing source is different from bbg return pricing source'),
+    ]
+
     def __init__(self):
         pass
 
     @staticmethod
-    def validate_identifier(bbg_df, get_getdata_desc_of):
+    def validate(bbg_df, getdata_descs, rules=None):
         """
-        check if row status is anything other than 0
-        :return:
+        Set STATUS and public_msg of every row from the first matching rule
+        :param getdata_descs: {bbg return status code: getdata description}
         """
-        logging.info('Validate Identifiers...')
-        bbg_df.loc[bbg_df.BBG_ROW_STATUS.astype(int) != 0, 'STATUS'] = \
-            DatsBbgRequestStatusEnum.INVALID.value
-        bbg_df.loc[bbg_df.BBG_ROW_STATUS.astype(int) != 0, 'public_msg'] = \
-            bbg_df.loc[bbg_df.BBG_ROW_STATUS.astype(int) != 0,
-                       'BBG_ROW_STATUS'].apply(
-                lambda r: get_getdata_desc_of(int(r)))
-
-    @staticmethod
-    def validate_mnemonic(bbg_df):
-        """
-        # the column in question contains the value
-        :return:
-        """
-        logging.info('Validate Mnemonic...')
-        bbg_df.loc[bbg_df.return_val == 'FLD UNKNOWN',
-                   'STATUS'] = DatsBbgRequestStatusEnum.INVALID.value
-        bbg_df.loc[bbg_df.return_val == 'FLD UNKNOWN',
-                   'public_msg'] = 'Invalid BBG Mnemonic'
-
-    @staticmethod
-    def validate_yellow_key(bbg_df):
-        logging.info('Validate yellow key...')
-        where = (bbg_df['STATUS'] != DatsBbgRequestStatusEnum.INVALID.value) & \
-                (bbg_df['req_yellow_key'] != bbg_df['BBG_MARKET_SECTOR_DES'])
-        bbg_df.loc[where, 'STATUS'] = DatsBbgRequestStatusEnum.INVALID.value
-        bbg_df.loc[
-            where, 'public_msg'] = 'Requested yellow is not matching with ' \
-                                   'bbg return yellow key'
-
-    @staticmethod
-    def update_onhold_reg_status(bbg_df):
-        logging.info('Validate on-hold register...')
-        where = (bbg_df['STATUS'] != DatsBbgRequestStatusEnum.INVALID.value) & \
-                (bbg_df['req_is_register_series'] == 0)
-        bbg_df.loc[where, 'STATUS'] = DatsBbgRequestStatusEnum.ONHOLD_REG.value
-        bbg_df.loc[
-            where, 'public_msg'] = 'Request submitted with registration onhold'
-
-    @staticmethod
-    def validate_pricing_source(bbg_df):
-        logging.info('Validate pricing source...')
-        where = (bbg_df['STATUS'] != DatsBbgRequestStatusEnum.INVALID.value) & \
-                (bbg_df.req_pricing_source is not None and
-                 bbg_df.BBG_PRICING_SOURCE != '') & \
-                (bbg_df.req_pricing_source != bbg_df.BBG_PRICING_SOURCE)
-
-        bbg_df.loc[where, 'STATUS'] = DatsBbgRequestStatusEnum.INVALID.value
-        bbg_df.loc[
-            where, 'public_msg'] = 'Requested pricing source is different ' \
-                                   'from bbg return pricing source'
+        rules = ValidationUtility.RULES if rules is None else rules
+        ctx = ValidationUtility.rule_context(bbg_df, getdata_descs)
+        matches = []
+        for rule in rules:
+            logging.info('Validate {}...'.format(rule.name))
+            matches.append(np.asarray(rule.applies(bbg_df, ctx), dtype=bool))
+        msgs = [np.asarray(r.public_msg(bbg_df, ctx), dtype=object)
+                if callable(r.public_msg) else r.public_msg for r in rules]
+        bbg_df['STATUS'] = np.select(matches, [r.status for r in rules],
+                                     ValidationUtility.VALID).astype(object)
+        bbg_df['public_msg'] = np.select(matches, msgs,
+                                         ValidationUtility.VALID_MSG).astype(object)
 
     @staticmethod
-    def update_validated_status(bbg_df):
-        where = (bbg_df['STATUS'] != DatsBbgRequestStatusEnum.INVALID.value)
-        bbg_df.loc[where, 'STATUS'] = DatsBbgRequestStatusEnum.VALID.value
-        bbg_df.loc[where, 'public_msg'] = 'Series successfully processed'
+    def rule_context(bbg_df, getdata_descs):
+        row_status = bbg_df['BBG_ROW_STATUS'].astype(int)
+        row_status_desc = row_status.map(getdata_descs)
+        unknown = (row_status != 0) & ~row_status.isin(list(getdata_descs))
+        if unknown.any():
+            raise KeyError(row_status[unknown].iloc[0])
+        return {'row_status': row_status, 'row_status_desc': row_status_desc}
 
 
 if __name__ == '__main__':
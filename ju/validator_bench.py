@@ -0,0 +1,97 @@
+"""
+Micro-benchmarks for the DATS validator dataframe build, run with --rows/--mnemonics to size one bt_request_id.
+"""
+import time
+
+import pandas as pd
+
+from dats_repo import DatsBbgRequest
+from validator import ValidatorPollingAgent, HEADER_PREFIX
+from etl.core.util import parse_args
+
+USAGE = ['DATS Validator benchmark',
+         ('--rows', {'help': 'Comma separated request rows per bt_request_id',
+                     'default': '1000,10000,50000,200000'}),
+         ('--mnemonics', {'help': 'Number of distinct mnemonics requested', 'type': int, 'default': 20}),
+         ('--legacy-max', {'help': 'Largest row count to time the per row versions at', 'type': int,
+                           'default': 10000})
+         ]
+
+
+def make_requests(rows, mnemonics):
+    return [DatsBbgRequest(dats_bbg_request_id=i,
+                           dats_bbg_request_status_code='PENDING',
+                           req_ticker='SEC{}'.format(i),
+                           req_yellow_key='Equity',
+                           req_mnemonic='FIELD_{}'.format(i % mnemonics),
+                           req_bbg_interface_code='GETDATA',
+                           req_tag='##{}##'.format(i),
+                           req_is_register_series='N',
+                           bt_request_id='BT1')
+            for i in range(rows)]
+
+
+def make_joined_df(request_df, mnemonics):
+    df = request_df.copy()
+    for j in range(mnemonics):
+        df[HEADER_PREFIX + 'FIELD_{}'.format(j)] = ['{}.{}'.format(i, j) for i in range(len(df))]
+    return df
+
+
+def legacy_transform_request_to_df(requests):
+    """
+    transform_request_to_df as it was, a DatsBbgRequest and dict built per row
+    """
+    reqs = [DatsBbgRequest(dats_bbg_request_id=r.dats_bbg_request_id,
+                           dats_bbg_request_status_code=r.dats_bbg_request_status_code,
+                           req_ticker=r.req_ticker,
+                           req_yellow_key=r.req_yellow_key,
+                           req_mnemonic=r.req_mnemonic,
+                           req_bbg_interface_code=r.req_bbg_interface_code,
+                           req_pricing_source=r.req_pricing_source,
+                           req_overrides=r.req_overrides,
+                           req_optional_elements=r.req_optional_elements,
+                           req_tag=r.req_tag,
+                           req_is_register_series=r.req_is_register_series,
+                           bt_request_id=r.bt_request_id).to_dict()
+            for r in requests]
+    return pd.DataFrame.from_records(reqs)
+
+
+def legacy_find_mnemonic_value(request_df):
+    """
+    find_mnemonic_value as it was, get_loc per row then a scalar .loc assignment per row
+    """
+    request_df['col_no'] = request_df['req_mnemonic'].apply(
+        lambda r: request_df.columns.get_loc(HEADER_PREFIX + r))
+    for i, w in request_df['col_no'].iteritems():
+        request_df.loc[i, 'return_val'] = request_df.iloc[i, w]
+
+
+def timed_call(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+
+def bench(row_counts, mnemonics, legacy_max):
+    print('Validator dataframe build, {} mnemonics'.format(mnemonics))
+    print('  {:>10}{:>14}{:>14}{:>14}{:>14}'.format('rows', 'to_df', 'to_df old', 'find', 'find old'))
+    for rows in row_counts:
+        requests = make_requests(rows, mnemonics)
+        to_df_time, request_df = timed_call(ValidatorPollingAgent.requests_to_df, requests)
+        joined = make_joined_df(request_df, mnemonics)
+        find_time, _ = timed_call(ValidatorPollingAgent.find_mnemonic_value, joined.copy())
+        if rows <= legacy_max:
+            old_to_df_time, _ = timed_call(legacy_transform_request_to_df, requests)
+            legacy_df = joined.copy()
+            old_find_time, _ = timed_call(legacy_find_mnemonic_value, legacy_df)
+            old = ['{:.2f}'.format(old_to_df_time), '{:.2f}'.format(old_find_time)]
+        else:
+            old = ['-', '-']
+        print('  {:>10}{:>14.2f}{:>14}{:>14.2f}{:>14}'.format(rows, to_df_time, old[0], find_time, old[1]))
+
+
+if __name__ == '__main__':
+    args = parse_args(*USAGE)
+    bench([int(r) for r in args.rows.split(',')], args.mnemonics, args.legacy_max)